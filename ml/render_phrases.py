@@ -1,53 +1,125 @@
 from playwright.sync_api import sync_playwright
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import requests
+from tqdm import tqdm
 import random
 import shutil
-import colorsys
+import base64
+import re
+import hashlib
+import queue
+import threading
+from multiprocessing import Pool, cpu_count
+
+# Offset of #container from the page origin (body padding, no margin)
+BODY_PADDING = 20
+# Samples are saved as JPEG by default (much cheaper to encode than PNG);
+# pass image_format="png" for lossless output
+JPEG_QUALITY = 85
+IMAGE_EXTENSIONS = {"jpeg": "jpg", "png": "png"}
+# Persistent Chromium profiles (HTTP + font cache) that survive across runs
+BROWSER_CACHE_DIR = Path(__file__).parent / ".pw-cache"
+BROWSER_DISK_CACHE_SIZE = 128 * 1024 * 1024
+# Writer threads per render worker, and how many encoded samples may be
+# waiting for them before rendering blocks
+WRITER_THREADS = 4
+WRITE_QUEUE_SIZE = 32
+# Self-hosted, subsetted copies of the Google Fonts used for rendering
+FONT_CACHE_DIR = Path(__file__).parent / "fonts"
+GOOGLE_FONTS_CSS = "https://fonts.googleapis.com/css2?family={family}:wght@400&display=swap"
+# Google Fonts only serves woff2 to browsers it recognises
+FONT_USER_AGENT = (
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+)
+# Number of (bg, text) color pairs generated per batch
+COLOR_POOL_SIZE = 10_000
+
+# Styles #container for one sample and returns its rendered height. Kept as a
+# constant so Chromium compiles it once; arguments are marshalled by Playwright.
+RENDER_FN = """
+([text, fontFamily, containerWidth, fontSize, paddingTop, paddingRight, paddingBottom, paddingLeft, textAlign, bgColor, textColor, fontWeight]) => {
+    const container = document.getElementById('container');
+    container.style.width = containerWidth + 'px';
+    container.style.fontFamily = '"' + fontFamily + '", sans-serif';
+    container.style.fontSize = fontSize + 'px';
+    container.style.color = textColor || 'black';
+    container.style.backgroundColor = bgColor || 'white';
+    container.style.fontWeight = fontWeight || 'normal';
+    container.style.wordWrap = 'break-word';
+    container.style.padding = paddingTop + 'px ' + paddingRight + 'px ' + paddingBottom + 'px ' + paddingLeft + 'px';
+    container.style.textAlign = textAlign;
+    container.textContent = text;
+    return container.getBoundingClientRect().height;
+}
+"""
+
+
+def _hsv_to_rgb(h, s, v):
+    """Vectorized colorsys.hsv_to_rgb over equal-length arrays"""
+    i = (h * 6.0).astype(int)
+    f = h * 6.0 - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    i = i % 6
+    conditions = [i == k for k in range(6)]
+    r = np.select(conditions, [v, q, p, p, t, v])
+    g = np.select(conditions, [t, v, v, q, p, p])
+    b = np.select(conditions, [p, p, t, v, v, q])
+    return np.stack([r, g, b], axis=1)
+
+
+def _format_rgb(rgb):
+    """Format an (N, 3) int array as CSS rgb() strings"""
+    channels = rgb.astype(str)
+    out = np.char.add("rgb(", channels[:, 0])
+    out = np.char.add(np.char.add(out, ","), channels[:, 1])
+    out = np.char.add(np.char.add(out, ","), channels[:, 2])
+    return np.char.add(out, ")").tolist()
+
 
 class FontDatasetGenerator:
     def __init__(self, output_dir="data"):
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(exist_ok=True)
         self.playwright = None
-        self.browser = None
+        self.context = None
         self.page = None
+        self.cdp = None
+        self._color_pool = []
     
+    def _build_color_pool(self, n=COLOR_POOL_SIZE):
+        """Pre-generate n (bg, text) color pairs with sufficient contrast"""
+        rng = np.random.default_rng()
+
+        # Generate random background colors
+        bg_hsv = rng.random((n, 3))
+        bg_hsv[:, 1] = 0.1 + bg_hsv[:, 1] * 0.8
+        bg_hsv[:, 2] = 0.2 + bg_hsv[:, 2] * 0.7
+        bg_rgb = (_hsv_to_rgb(bg_hsv[:, 0], bg_hsv[:, 1], bg_hsv[:, 2]) * 255).astype(int)
+
+        # Calculate luminance for contrast
+        c = bg_rgb / 255.0
+        c = np.where(c <= 0.03928, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+        bg_lum = c @ np.array([0.2126, 0.7152, 0.0722])
+
+        # Choose text color for good contrast: dark text on light backgrounds,
+        # light text on dark ones
+        text_hsv = rng.random((n, 3))
+        text_hsv[:, 1] *= 0.8
+        text_hsv[:, 2] = np.where(bg_lum > 0.5, text_hsv[:, 2] * 0.3, 0.7 + text_hsv[:, 2] * 0.3)
+        text_rgb = (_hsv_to_rgb(text_hsv[:, 0], text_hsv[:, 1], text_hsv[:, 2]) * 255).astype(int)
+
+        return list(zip(_format_rgb(bg_rgb), _format_rgb(text_rgb)))
+
     def generate_contrasting_colors(self):
         """Generate background and text colors with sufficient contrast"""
-        # Generate random background color
-        bg_hue = random.random()
-        bg_sat = random.uniform(0.1, 0.9)
-        bg_val = random.uniform(0.2, 0.9)
-        
-        bg_r, bg_g, bg_b = colorsys.hsv_to_rgb(bg_hue, bg_sat, bg_val)
-        bg_r, bg_g, bg_b = int(bg_r * 255), int(bg_g * 255), int(bg_b * 255)
-        
-        # Calculate luminance for contrast
-        def luminance(r, g, b):
-            r, g, b = [x/255.0 for x in (r, g, b)]
-            r = r/12.92 if r <= 0.03928 else ((r+0.055)/1.055)**2.4
-            g = g/12.92 if g <= 0.03928 else ((g+0.055)/1.055)**2.4
-            b = b/12.92 if b <= 0.03928 else ((b+0.055)/1.055)**2.4
-            return 0.2126*r + 0.7152*g + 0.0722*b
-        
-        bg_lum = luminance(bg_r, bg_g, bg_b)
-        
-        # Choose text color for good contrast (aim for 4.5:1 ratio minimum)
-        if bg_lum > 0.5:
-            # Light background, use dark text
-            text_val = random.uniform(0.0, 0.3)
-        else:
-            # Dark background, use light text
-            text_val = random.uniform(0.7, 1.0)
-            
-        text_hue = random.random()
-        text_sat = random.uniform(0.0, 0.8)
-        
-        text_r, text_g, text_b = colorsys.hsv_to_rgb(text_hue, text_sat, text_val)
-        text_r, text_g, text_b = int(text_r * 255), int(text_g * 255), int(text_b * 255)
-        
-        return f"rgb({bg_r},{bg_g},{bg_b})", f"rgb({text_r},{text_g},{text_b})"
+        if not self._color_pool:
+            self._color_pool = self._build_color_pool()
+        return self._color_pool.pop()
         
     def get_google_fonts(self, limit=50):
         """Get list of popular Google Fonts"""
@@ -59,27 +131,113 @@ class FontDatasetGenerator:
             'Ubuntu', 'Playfair Display', 'Merriweather', 'Poppins', 'Inter'
         ][:limit]
     
-    def start_browser(self, fonts):
+    def _font_chars(self, texts):
+        """Characters a font subset must cover: Latin-1 plus everything in texts"""
+        chars = set(map(chr, range(0x20, 0x100))) | set(''.join(texts))
+        return ''.join(sorted(chars))
+
+    def _font_cache_path(self, font, chars):
+        # Keyed on the character set so a subset is never reused for text it lacks
+        digest = hashlib.sha1(chars.encode('utf-8')).hexdigest()[:12]
+        return FONT_CACHE_DIR / f"{font.replace(' ', '_')}-{digest}.woff2"
+
+    def _prefetch_fonts(self, fonts, chars):
+        """Download each font's latin woff2 once and subset it to chars"""
+        from fontTools import subset
+
+        FONT_CACHE_DIR.mkdir(exist_ok=True)
+
+        for font in fonts:
+            cache_path = self._font_cache_path(font, chars)
+            if cache_path.exists():
+                continue
+
+            try:
+                css = requests.get(
+                    GOOGLE_FONTS_CSS.format(family=font.replace(' ', '+')),
+                    headers={"User-Agent": FONT_USER_AGENT},
+                    timeout=30,
+                )
+                if css.status_code != 200:
+                    # Not a Google Font (e.g. Arial); the browser resolves it locally
+                    print(f"  No Google Font for {font}, using system font")
+                    continue
+
+                # The CSS has one @font-face per unicode-range, each labelled
+                # with a comment; take the latin one
+                blocks = dict(re.findall(r"/\*\s*([\w-]+)\s*\*/\s*@font-face\s*\{([^}]*)\}", css.text))
+                block = blocks.get('latin', css.text)
+                match = re.search(r"url\((.*?)\)\s*format\('woff2'\)", block)
+                if match is None:
+                    print(f"  No woff2 source for {font}, falling back to Google Fonts CDN")
+                    continue
+                woff2 = requests.get(match.group(1), timeout=30)
+                woff2.raise_for_status()
+            except requests.RequestException as e:
+                print(f"  Could not fetch {font}, falling back to Google Fonts CDN: {e}")
+                continue
+
+            raw_path = cache_path.with_suffix('.full.woff2')
+            raw_path.write_bytes(woff2.content)
+
+            options = subset.Options()
+            options.flavor = 'woff2'
+            ttfont = subset.load_font(str(raw_path), options)
+            subsetter = subset.Subsetter(options)
+            subsetter.populate(text=chars)
+            subsetter.subset(ttfont)
+            subset.save_font(ttfont, str(cache_path), options)
+            raw_path.unlink()
+
+            print(f"  Cached {font} -> {cache_path.name}")
+
+    def start_browser(self, fonts, chars, profile="default"):
         """Initialize browser instance with all fonts preloaded"""
         if not self.playwright:
             self.playwright = sync_playwright().start()
-            self.browser = self.playwright.chromium.launch(headless=True)
-            self.page = self.browser.new_page()
-            self._setup_fonts(fonts)
+            # Chromium locks its profile, so each concurrent browser needs its own
+            self.context = self.playwright.chromium.launch_persistent_context(
+                str(BROWSER_CACHE_DIR / profile),
+                headless=True,
+                args=[f"--disk-cache-size={BROWSER_DISK_CACHE_SIZE}"],
+            )
+            self.page = self.context.pages[0] if self.context.pages else self.context.new_page()
+            self.cdp = self.context.new_cdp_session(self.page)
+            self._setup_fonts(fonts, chars)
     
     def stop_browser(self):
         """Clean up browser instance"""
-        if self.browser:
-            self.browser.close()
+        if self.context:
+            self.context.close()
         if self.playwright:
             self.playwright.stop()
     
-    def _setup_fonts(self, fonts):
+    def _setup_fonts(self, fonts, chars):
         """Setup HTML page with all fonts preloaded"""
-        font_links = '\n'.join([
-            f'<link href="https://fonts.googleapis.com/css2?family={font.replace(" ", "+")}:wght@400&display=swap" rel="stylesheet">'
-            for font in fonts
-        ])
+        # Inline cached fonts as data URLs (the about:blank page cannot load
+        # file:// resources); fall back to Google Fonts for anything not cached
+        font_faces = []
+        font_links = []
+        for font in fonts:
+            cache_path = self._font_cache_path(font, chars)
+            if cache_path.exists():
+                data = base64.b64encode(cache_path.read_bytes()).decode('ascii')
+                font_faces.append(
+                    f"@font-face {{ font-family: '{font}'; font-weight: 400; "
+                    f"src: url(data:font/woff2;base64,{data}) format('woff2'); }}"
+                )
+            else:
+                font_links.append(
+                    f'<link href="{GOOGLE_FONTS_CSS.format(family=font.replace(" ", "+"))}" rel="stylesheet">'
+                )
+        if font_links:
+            # Open both CDN connections while the stylesheet request is in flight
+            font_links = [
+                '<link rel="preconnect" href="https://fonts.googleapis.com">',
+                '<link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>',
+            ] + font_links
+        font_faces = '\n'.join(font_faces)
+        font_links = '\n'.join(font_links)
         
         html_content = f"""
         <!DOCTYPE html>
@@ -87,80 +245,88 @@ class FontDatasetGenerator:
         <head>
             {font_links}
             <style>
-                body {{ margin: 0; padding: 20px; }}
+                {font_faces}
+                body {{ margin: 0; padding: {BODY_PADDING}px; }}
                 #container {{ background: white; }}
             </style>
         </head>
         <body>
             <div id="container"></div>
-            <script>
-                function renderText(text, fontFamily, containerWidth, fontSize, paddingTop, paddingRight, paddingBottom, paddingLeft, textAlign, bgColor, textColor, fontWeight) {{
-                    const container = document.getElementById('container');
-                    container.style.width = containerWidth + 'px';
-                    container.style.fontFamily = '"' + fontFamily + '", sans-serif';
-                    container.style.fontSize = fontSize + 'px';
-                    container.style.color = textColor || 'black';
-                    container.style.backgroundColor = bgColor || 'white';
-                    container.style.fontWeight = fontWeight || 'normal';
-                    container.style.wordWrap = 'break-word';
-                    container.style.padding = paddingTop + 'px ' + paddingRight + 'px ' + paddingBottom + 'px ' + paddingLeft + 'px';
-                    container.style.textAlign = textAlign;
-                    container.textContent = text;
-                }}
-            </script>
         </body>
         </html>
         """
         
         self.page.set_content(html_content)
         
-        # Wait for fonts to load
+        # Wait until every font has actually been loaded
         self.page.evaluate("""
-            async () => {
+            async (fonts) => {
+                await Promise.all(fonts.map(f => document.fonts.load('16px "' + f + '"')));
                 await document.fonts.ready;
-                await new Promise(resolve => setTimeout(resolve, 1000));
             }
-        """)
+        """, fonts)
     
-    def render_font_sample(self, text, font_family):
+    def sample_render_params(self, n):
+        """Draw n random (font_size, paddings, width_extra, alignment, use_color, bold) rows at once"""
+        rng = np.random.default_rng()
+
+        font_sizes = rng.integers(10, 101, n)
+        # Random padding for each side: top, right, bottom, left
+        paddings = rng.integers(0, 151, (n, 4))
+        # Extra container width on top of the text-length based width
+        width_extras = rng.integers(200, 801, n)
+        alignments = rng.choice(['left', 'center', 'right'], n)
+        # Use color and bold 50% of the time each
+        use_colors = rng.random(n) < 0.5
+        bolds = rng.random(n) < 0.5
+
+        # tolist() so Playwright gets plain Python values
+        return list(zip(
+            font_sizes.tolist(), paddings.tolist(), width_extras.tolist(),
+            alignments.tolist(), use_colors.tolist(), bolds.tolist(),
+        ))
+
+    def render_font_sample(self, text, font_family, params=None, image_format="jpeg"):
         """Render text with specified font in a container of random width and size"""
-        
-        font_size = random.randint(10, 100)
-        
-        # Random padding for each side
-        padding_top = random.randint(0, 150)
-        padding_right = random.randint(0, 150)
-        padding_bottom = random.randint(0, 150)
-        padding_left = random.randint(0, 150)
+        if params is None:
+            params = self.sample_render_params(1)[0]
+        font_size, paddings, width_extra, text_alignment, use_color, bold = params
+        padding_top, padding_right, padding_bottom, padding_left = paddings
 
         # Adjust container width based on text length
-        container_width = int(len(text) * font_size / 10. + random.randint(200, 800))
-        
-        # Random text alignment
-        alignments = ['left', 'center', 'right']
-        text_alignment = random.choice(alignments)
+        container_width = int(len(text) * font_size / 10. + width_extra)
         
-        # Use color 50% of the time
-        use_color = random.random() < 0.5
         if use_color:
             bg_color, text_color = self.generate_contrasting_colors()
         else:
             bg_color, text_color = 'white', 'black'
         
-        # Random font weight (50% chance of bold)
-        font_weight = 'bold' if random.random() < 0.5 else 'normal'
+        font_weight = 'bold' if bold else 'normal'
         
-        # Escape text for JavaScript
-        escaped_text = text.replace('\\', '\\\\').replace('"', '\\"').replace("'", "\\'")
-        
-        # Render text in container
-        self.page.evaluate(f'''
-            renderText("{escaped_text}", "{font_family}", {container_width}, {font_size}, {padding_top}, {padding_right}, {padding_bottom}, {padding_left}, "{text_alignment}", "{bg_color}", "{text_color}", "{font_weight}")
-        ''')
-        
-        # Take screenshot of container
-        container = self.page.locator('#container')
-        screenshot = container.screenshot()
+        # Render text in container; its height comes back with the same call
+        container_height = self.page.evaluate(
+            RENDER_FN,
+            [text, font_family, container_width, font_size, padding_top, padding_right,
+             padding_bottom, padding_left, text_alignment, bg_color, text_color, font_weight],
+        )
+
+        # Capture the container directly over CDP; the clip is known up front
+        # so no locator query is needed
+        capture = {
+            "format": image_format,
+            "clip": {
+                "x": BODY_PADDING,
+                "y": BODY_PADDING,
+                "width": container_width + padding_left + padding_right,
+                "height": container_height,
+                "scale": 1,
+            },
+            "captureBeyondViewport": True,
+        }
+        if image_format == "jpeg":
+            capture["quality"] = JPEG_QUALITY
+        result = self.cdp.send("Page.captureScreenshot", capture)
+        screenshot = base64.b64decode(result["data"])
         
         return screenshot
     
@@ -169,8 +335,12 @@ class FontDatasetGenerator:
         df = pd.read_csv(csv_path)
         return df['phrase'].tolist()
     
-    def generate_samples(self, texts=None, fonts=None, samples_per_font=500):
+    def generate_samples(self, texts=None, fonts=None, samples_per_font=500, num_workers=None,
+                         image_format="jpeg"):
         """Generate font samples and save as images"""
+        if image_format not in IMAGE_EXTENSIONS:
+            raise ValueError(f"Unsupported image format: {image_format}")
+
         # Clear existing data folder
         if self.output_dir.exists():
             print(f"Clearing existing data folder: {self.output_dir}")
@@ -184,30 +354,103 @@ class FontDatasetGenerator:
         if fonts is None:
             fonts = self.get_google_fonts(20)
         
-        print(f"Generating samples for {len(fonts)} fonts...")
-        
+        if num_workers is None:
+            num_workers = min(cpu_count(), 4)
+
+        texts = texts[:samples_per_font]
+        chars = self._font_chars(texts)
+
+        print("Prefetching fonts...")
+        self._prefetch_fonts(fonts, chars)
+
+        print(f"Generating samples for {len(fonts)} fonts with {num_workers} browsers...")
+
+        for font_family in fonts:
+            font_dir = self.output_dir / font_family.replace(' ', '_')
+            font_dir.mkdir(exist_ok=True)
+
+        work = [
+            (font_family, text_idx, text)
+            for font_family in fonts
+            for text_idx, text in enumerate(texts)
+        ]
+        work = [item + (params,) for item, params in zip(work, self.sample_render_params(len(work)))]
+
+        # Interleave so every browser renders a mix of fonts
+        shards = [
+            (i, str(self.output_dir), fonts, chars, image_format, work[i::num_workers])
+            for i in range(num_workers)
+        ]
+
+        # One independent browser per process; pages sharing a browser
+        # serialize their screenshots
+        with Pool(num_workers) as pool:
+            total = sum(pool.map(_render_worker, shards))
+
+        print(f"Generated {total} samples")
+
+
+def _write_image(filepath, data):
+    """Write encoded image bytes in a single call"""
+    filepath.write_bytes(data)
+
+
+def _writer(write_queue, errors):
+    """Consume (filepath, bytes) items until a None sentinel arrives"""
+    while True:
+        item = write_queue.get()
         try:
-            self.start_browser(fonts)
-            
-            for font_idx, font_family in enumerate(fonts):
-                print(f"Processing {font_family} ({font_idx+1}/{len(fonts)})")
-                
-                font_dir = self.output_dir / font_family.replace(' ', '_')
-                font_dir.mkdir(exist_ok=True)
-                
-                for text_idx, text in enumerate(texts[:samples_per_font]):
-                    screenshot = self.render_font_sample(text, font_family)
-                    
-                    filename = f"sample_{text_idx:02d}.png"
-                    filepath = font_dir / filename
-                    
-                    with open(filepath, 'wb') as f:
-                        f.write(screenshot)
-                        
-                    print(f"  Saved: {filename}")
-        
+            if item is None:
+                return
+            _write_image(*item)
+        except Exception as e:
+            errors.append(e)
         finally:
-            self.stop_browser()
+            write_queue.task_done()
+
+
+def _render_worker(args):
+    """Render a shard of (font, text_idx, text, params) items in its own browser"""
+    worker_idx, output_dir, fonts, chars, image_format, items = args
+    extension = IMAGE_EXTENSIONS[image_format]
+
+    # Rendering produces into a bounded queue; writer threads absorb the disk
+    # latency while the next sample renders
+    write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    errors = []
+    writers = [
+        threading.Thread(target=_writer, args=(write_queue, errors), daemon=True)
+        for _ in range(WRITER_THREADS)
+    ]
+    for writer in writers:
+        writer.start()
+
+    generator = FontDatasetGenerator(output_dir)
+    try:
+        generator.start_browser(fonts, chars, profile=f"worker-{worker_idx}")
+
+        progress = tqdm(items, desc=f"Browser {worker_idx}", position=worker_idx)
+        for font_family, text_idx, text, params in progress:
+            screenshot = generator.render_font_sample(text, font_family, params, image_format)
+
+            filename = f"sample_{text_idx:02d}.{extension}"
+            filepath = generator.output_dir / font_family.replace(' ', '_') / filename
+            write_queue.put((filepath, screenshot))
+
+    finally:
+        write_queue.join()
+        for _ in writers:
+            write_queue.put(None)
+        for writer in writers:
+            writer.join()
+        generator.stop_browser()
+
+    # Surface any write errors
+    if errors:
+        raise errors[0]
+
+    return len(items)
+
 
 if __name__ == "__main__":
     generator = FontDatasetGenerator()
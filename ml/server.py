@@ -1,17 +1,43 @@
 from pathlib import Path
-from io import BytesIO
-from typing import List, Optional
+from io import SEEK_END, BytesIO
+from typing import BinaryIO, List, Optional, Tuple, Union
+import asyncio
 import base64
+import logging
+import random
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.nn as nn
 from PIL import Image
 from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
 
 app = FastAPI(title="Font Classifier API", version="0.1.0")
+logger = logging.getLogger(__name__)
+
+# Model input size; images are resized to RESIZE_SIZE before the center crop
+IMG_SIZE = 224
+RESIZE_SIZE = int(IMG_SIZE * 1.15)
+# ImageNet normalization the checkpoint was trained with, and the single-channel
+# normalization used for grayscale input (see to_grayscale_input)
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+GRAY_MEAN = [sum(IMAGENET_MEAN) / 3]
+GRAY_STD = [sum(IMAGENET_STD) / 3]
+# Number of predictions reported per request
+TOPK = 5
+# Concurrent requests are coalesced into one forward pass of up to
+# MAX_BATCH images, waiting at most MAX_WAIT seconds for the batch to fill
+MAX_BATCH = 16
+MAX_WAIT = 0.008
+# Images from the generated dataset used to calibrate INT8 quantization
+CALIB_DIR = Path(__file__).parent / "data"
+CALIB_SAMPLES = 64
 
 
 def get_device() -> torch.device:
@@ -32,6 +58,115 @@ def build_model(num_classes: int) -> nn.Module:
     return model
 
 
+def to_grayscale_input(model: nn.Module) -> nn.Module:
+    """Replace conv1 with a 1-channel conv for grayscale input normalized with GRAY_MEAN/GRAY_STD.
+
+    The checkpoint was trained on gray images replicated to 3 channels and
+    normalized per channel. Folding each channel's scale into the conv
+    weights and its offset into bn1's running mean gives the same activations
+    (up to zero-padding at the borders) from a single channel.
+    """
+    conv, bn = model.conv1, model.bn1
+    mean = torch.tensor(IMAGENET_MEAN, device=conv.weight.device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, device=conv.weight.device).view(1, 3, 1, 1)
+    with torch.no_grad():
+        w = conv.weight
+        new_conv = nn.Conv2d(1, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, bias=False)
+        new_conv.weight.copy_((w * GRAY_STD[0] / std).sum(dim=1, keepdim=True))
+        offset = (w * (GRAY_MEAN[0] - mean) / std).sum(dim=(1, 2, 3))
+        bn.running_mean.sub_(offset)
+    model.conv1 = new_conv.to(w.device)
+    return model
+
+
+def optimize_model(model: nn.Module, device: torch.device, img_size: int) -> nn.Module:
+    """Compile an eval-mode model for serving: FP16 + torch.compile on CUDA, frozen TorchScript elsewhere.
+
+    mode="reduce-overhead" captures CUDA graphs per thread, so they are only
+    replayed if warm-up and every forward pass run on the same thread (see
+    infer_executor).
+    """
+    if device.type == "cuda":
+        model = model.half()
+        return torch.compile(model, mode="reduce-overhead")
+    with torch.no_grad():
+        example = torch.randn(1, 1, img_size, img_size, device=device).to(memory_format=torch.channels_last)
+        traced = torch.jit.trace(model, example)
+    return torch.jit.freeze(traced)
+
+
+class OnnxModel:
+    """Callable wrapper so an ONNX Runtime session can stand in for the torch model"""
+
+    def __init__(self, session):
+        self.session = session
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        logits = self.session.run(None, {"input": batch.cpu().contiguous().numpy()})[0]
+        return torch.from_numpy(logits)
+
+
+def build_int8_model(model: nn.Module, ckpt_path: Path, tfms, img_size: int) -> Optional[OnnxModel]:
+    """Export to ONNX and statically quantize to INT8 for ONNX Runtime on CPU.
+
+    The quantized model is cached next to the checkpoint. Returns None when
+    onnxruntime is not installed, there is no calibration data, or export or
+    quantization fails, so the caller can fall back to TorchScript.
+    """
+    try:
+        import onnxruntime as ort
+        from onnxruntime.quantization import CalibrationDataReader, QuantType, quantize_static
+    except ImportError:
+        return None
+
+    int8_path = ckpt_path.with_suffix(".gray.int8.onnx")
+    if not int8_path.exists() or int8_path.stat().st_mtime < ckpt_path.stat().st_mtime:
+        calib_paths = sorted(p for ext in ("*.png", "*.jpg") for p in CALIB_DIR.glob(f"*/{ext}"))
+        if not calib_paths:
+            return None
+        calib_paths = random.Random(0).sample(calib_paths, min(CALIB_SAMPLES, len(calib_paths)))
+
+        class Reader(CalibrationDataReader):
+            def __init__(self):
+                self.paths = iter(calib_paths)
+
+            def get_next(self):
+                p = next(self.paths, None)
+                if p is None:
+                    return None
+                x = normalize_(tfms(Image.open(p).convert("RGB")).unsqueeze(0))
+                return {"input": x.numpy()}
+
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                fp32_path = Path(tmp) / "model.fp32.onnx"
+                torch.onnx.export(
+                    model.cpu(),
+                    torch.randn(1, 1, img_size, img_size),
+                    str(fp32_path),
+                    input_names=["input"],
+                    output_names=["logits"],
+                    dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+                )
+                quantize_static(
+                    str(fp32_path), str(int8_path), Reader(),
+                    per_channel=True, weight_type=QuantType.QInt8, activation_type=QuantType.QUInt8,
+                )
+        except Exception as e:
+            logger.warning(f"INT8 export/quantization failed, using TorchScript instead: {e}")
+            int8_path.unlink(missing_ok=True)
+            return None
+
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    try:
+        session = ort.InferenceSession(str(int8_path), sess_options, providers=["CPUExecutionProvider"])
+    except Exception as e:
+        logger.warning(f"Could not load {int8_path.name}, using TorchScript instead: {e}")
+        return None
+    return OnnxModel(session)
+
+
 def load_checkpoint(ckpt_path: Path, device: torch.device):
     ckpt = torch.load(ckpt_path, map_location=device)
     if "model_state" not in ckpt or "classes" not in ckpt:
@@ -40,21 +175,39 @@ def load_checkpoint(ckpt_path: Path, device: torch.device):
 
 
 def make_transforms(img_size: int):
-    from torchvision import transforms
-    return transforms.Compose([
-        transforms.Grayscale(3),
-        transforms.Resize(int(img_size * 1.15), antialias=True),
-        transforms.CenterCrop(img_size),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+    """Preprocessing that accepts either a PIL image or a uint8 CHW tensor (on any device).
+
+    Output is unnormalized float in [0, 1]; see normalize_().
+    """
+    from torchvision.transforms import v2
+    return v2.Compose([
+        v2.Grayscale(1),
+        v2.Resize(int(img_size * 1.15), antialias=True),
+        v2.CenterCrop(img_size),
+        v2.ToImage(),
+        v2.ToDtype(torch.float32, scale=True),
+        # Normalization is applied per batch in place, see normalize_()
     ])
 
 
+def normalize_(batch: torch.Tensor) -> torch.Tensor:
+    """Normalize an N1HW grayscale float batch in place"""
+    return batch.sub_(MEAN).div_(STD)
+
+
 # Globals populated at startup
 device: Optional[torch.device] = None
+MEAN: Optional[torch.Tensor] = None
+STD: Optional[torch.Tensor] = None
+dtype: torch.dtype = torch.float32
 classes: Optional[List[str]] = None
 model: Optional[nn.Module] = None
 tfms = None
+batch_queue: Optional[asyncio.Queue] = None
+# Warm-up and every forward pass run on this one thread: torch.compile's
+# CUDA graphs are captured per thread, so a worker pool would re-capture them
+infer_executor: Optional[ThreadPoolExecutor] = None
+batcher_task: Optional[asyncio.Task] = None
 
 
 class PredictB64(BaseModel):
@@ -62,10 +215,12 @@ class PredictB64(BaseModel):
 
 
 @app.on_event("startup")
-def startup() -> None:
-    global device, classes, model, tfms
+async def startup() -> None:
+    global device, dtype, MEAN, STD, classes, model, tfms, batch_queue, infer_executor, batcher_task
 
     device = get_device()
+    MEAN = torch.tensor(GRAY_MEAN, device=device).view(1, 1, 1, 1)
+    STD = torch.tensor(GRAY_STD, device=device).view(1, 1, 1, 1)
     ckpt_path = Path(__file__).parent / "checkpoints" / "best.ckpt.pt"
     if not ckpt_path.exists():
         raise RuntimeError(f"Checkpoint not found: {ckpt_path}")
@@ -75,7 +230,28 @@ def startup() -> None:
     model = build_model(num_classes=len(classes)).to(device)
     model.load_state_dict(state)
     model.eval()
-    tfms = make_transforms(img_size=224)
+    model = to_grayscale_input(model)
+    # NHWC lets cuDNN pick tensor-core friendly conv kernels
+    model = model.to(memory_format=torch.channels_last)
+    tfms = make_transforms(img_size=IMG_SIZE)
+
+    int8_model = build_int8_model(model, ckpt_path, tfms, img_size=IMG_SIZE) if device.type == "cpu" else None
+    model = int8_model or optimize_model(model, device, img_size=IMG_SIZE)
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+
+    infer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="infer")
+    await asyncio.get_running_loop().run_in_executor(infer_executor, _warmup)
+
+    batch_queue = asyncio.Queue()
+    batcher_task = asyncio.create_task(_batch_worker())
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    if batcher_task is not None:
+        batcher_task.cancel()
+    if infer_executor is not None:
+        infer_executor.shutdown(wait=False)
 
 
 @app.get("/health")
@@ -83,23 +259,82 @@ def health() -> JSONResponse:
     return JSONResponse({"status": "ok"})
 
 
-def _predict_from_pil(img: Image.Image) -> JSONResponse:
-    if model is None or classes is None or tfms is None or device is None:
-        raise HTTPException(status_code=503, detail="Model not ready")
-
-    with torch.no_grad():
-        batch = tfms(img).unsqueeze(0).to(device)
+def _warmup() -> None:
+    """Run forward passes at every batch size the batcher can produce.
+
+    Live traffic then doesn't pay for cuDNN autotuning, recompiles/CUDA-graph
+    capture per new shape or lazy CUDA init. Must run on infer_executor, the
+    thread _infer runs on.
+    """
+    runs = 3 if device.type == "cuda" else 1
+    with torch.inference_mode():
+        for batch_size in range(1, MAX_BATCH + 1):
+            dummy = torch.zeros(batch_size, 1, IMG_SIZE, IMG_SIZE, device=device, dtype=dtype)
+            dummy = dummy.to(memory_format=torch.channels_last)
+            for _ in range(runs):
+                model(dummy)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+
+def _infer(tensors: List[torch.Tensor]) -> Tuple[List[List[float]], List[List[int]]]:
+    """Run one forward pass over a batch and return per-image top-k (confs, idxs)"""
+    with torch.inference_mode():
+        # GPU-decoded JPEGs and PIL-decoded images can share a batch, so bring
+        # every tensor to the device before stacking
+        batch = torch.stack([t.to(device, non_blocking=True) for t in tensors])
+        batch = batch.to(memory_format=torch.channels_last)
+        batch = normalize_(batch).to(dtype)
         logits = model(batch)
-        probs = torch.softmax(logits, dim=1)[0]
+        probs = torch.softmax(logits.float(), dim=1)
+
+        # Only the top-k leave the device
+        confs, idxs = torch.topk(probs, k=min(TOPK, len(classes)), dim=1)
+        return confs.cpu().tolist(), idxs.cpu().tolist()
+
+
+async def _batch_worker() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await batch_queue.get()]
+        deadline = loop.time() + MAX_WAIT
+        while len(items) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        tensors, futures = zip(*items)
+        try:
+            confs, idxs = await loop.run_in_executor(infer_executor, _infer, list(tensors))
+        except Exception as e:
+            for fut in futures:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+
+        for fut, c, i in zip(futures, confs, idxs):
+            if not fut.done():
+                fut.set_result((c, i))
+
+
+async def _predict_from_image(img: Union[Image.Image, torch.Tensor]) -> JSONResponse:
+    if model is None or classes is None or tfms is None or device is None or batch_queue is None:
+        raise HTTPException(status_code=503, detail="Model not ready")
 
-        confs, idxs = torch.sort(probs, descending=True)
-        confs = confs.cpu().tolist()
-        idxs = idxs.cpu().tolist()
+    tensor = await run_in_threadpool(tfms, img)
+    fut = asyncio.get_running_loop().create_future()
+    await batch_queue.put((tensor, fut))
+    confs, idxs = await fut
 
-    # Print all predictions to stdout
-    for rank, (conf, idx) in enumerate(zip(confs, idxs)):
-        prefix = "*" if rank == 0 else " "
-        print(f"{prefix} {classes[idx]:20s}  {conf:.4f}")
+    # Only pay for formatting when debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        for rank, (conf, idx) in enumerate(zip(confs, idxs)):
+            prefix = "*" if rank == 0 else " "
+            logger.debug(f"{prefix} {classes[idx]:20s}  {conf:.4f}")
 
     top_idx = idxs[0]
     top_conf = float(confs[0])
@@ -108,22 +343,51 @@ def _predict_from_pil(img: Image.Image) -> JSONResponse:
     return JSONResponse({"font": top_font, "confidence": top_conf})
 
 
+def _load_image(fp: BinaryIO) -> Union[Image.Image, torch.Tensor]:
+    if device is not None and device.type == "cuda":
+        is_jpeg = fp.read(2) == b"\xff\xd8"
+        fp.seek(0)
+        if is_jpeg:
+            from torchvision.io import ImageReadMode, decode_jpeg
+            # Read the file once into a writable buffer and decode it straight
+            # to a uint8 tensor on the GPU (nvjpeg)
+            data = torch.empty(fp.seek(0, SEEK_END), dtype=torch.uint8)
+            fp.seek(0)
+            fp.readinto(data.numpy())
+            try:
+                return decode_jpeg(data, mode=ImageReadMode.RGB, device=device)
+            except RuntimeError:
+                fp.seek(0)  # JPEG variant nvjpeg can't handle, fall back to PIL
+
+    # PIL reads lazily from the file; for JPEGs, draft() lets libjpeg decode
+    # at a reduced scale that is still at least RESIZE_SIZE (no-op otherwise)
+    img = Image.open(fp)
+    img.draft("RGB", (RESIZE_SIZE, RESIZE_SIZE))
+    img = img.convert("RGB")
+
+    # Block-average very large images down cheaply, keeping at least twice
+    # RESIZE_SIZE for the antialiased resize to work from
+    factor = min(img.size) // (RESIZE_SIZE * 2)
+    if factor > 1:
+        img = img.reduce(factor)
+    return img
+
+
 @app.post("/predict")
-def predict(image: UploadFile = File(...)) -> JSONResponse:
+async def predict(image: UploadFile = File(...)) -> JSONResponse:
     if not image.content_type or not image.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="Please upload an image file")
 
     try:
-        raw = image.file.read()
-        img = Image.open(BytesIO(raw)).convert("RGB")
+        img = await run_in_threadpool(_load_image, image.file)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
 
-    return _predict_from_pil(img)
+    return await _predict_from_image(img)
 
 
 @app.post("/predict_b64")
-def predict_b64(body: PredictB64) -> JSONResponse:
+async def predict_b64(body: PredictB64) -> JSONResponse:
     data_str = body.image_b64.strip()
     if "," in data_str and ";base64" in data_str:
         # Support data URLs like: data:image/png;base64,XXXX
@@ -131,11 +395,11 @@ def predict_b64(body: PredictB64) -> JSONResponse:
 
     try:
         raw = base64.b64decode(data_str, validate=True)
-        img = Image.open(BytesIO(raw)).convert("RGB")
+        img = await run_in_threadpool(_load_image, BytesIO(raw))
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid base64 image: {e}")
 
-    return _predict_from_pil(img)
+    return await _predict_from_image(img)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,18 @@
 #!/usr/bin/env bash
 set -euo pipefail
 
-IMG_PATH="${1:-}"
-SERVER="${2:-http://localhost:8000}"
-if [ -z "$IMG_PATH" ]; then
-  echo "usage: bash test.sh ./data/sample_02.png [http://localhost:8000]" >&2
+# Images are sent concurrently so they land in the same server batch; pass a
+# JPEG and a PNG to check that mixed decode paths batch together.
+SERVER="http://localhost:8000"
+IMG_PATHS=()
+for ARG in "$@"; do
+  case "$ARG" in
+    http://*|https://*) SERVER="$ARG" ;;
+    *) IMG_PATHS+=("$ARG") ;;
+  esac
+done
+if [ "${#IMG_PATHS[@]}" -eq 0 ]; then
+  echo "usage: bash test.sh ./data/Inter/sample_02.jpg [./data/Roboto/sample_03.png ...] [http://localhost:8000]" >&2
   exit 1
 fi
 
@@ -15,9 +23,25 @@ if ! echo "$HEALTH" | grep -q '"status":"ok"'; then
   exit 1
 fi
 
-MIME=$(file -b --mime-type "$IMG_PATH" 2>/dev/null || echo image/png)
-B64=$(base64 < "$IMG_PATH" | tr -d '\n')
+OUT_DIR=$(mktemp -d)
+trap 'rm -rf "$OUT_DIR"' EXIT
 
-curl -s -X POST "$SERVER/predict_b64" \
-  -H 'Content-Type: application/json' \
-  -d "{\"image_b64\":\"data:$MIME;base64,$B64\"}"
\ No newline at end of file
+for i in "${!IMG_PATHS[@]}"; do
+  IMG_PATH="${IMG_PATHS[$i]}"
+  MIME=$(file -b --mime-type "$IMG_PATH" 2>/dev/null || echo image/png)
+  B64=$(base64 < "$IMG_PATH" | tr -d '\n')
+  curl -s -X POST "$SERVER/predict_b64" \
+    -H 'Content-Type: application/json' \
+    -d "{\"image_b64\":\"data:$MIME;base64,$B64\"}" > "$OUT_DIR/$i.json" &
+done
+wait
+
+STATUS=0
+for i in "${!IMG_PATHS[@]}"; do
+  RESULT=$(cat "$OUT_DIR/$i.json")
+  echo "${IMG_PATHS[$i]}: $RESULT"
+  if ! echo "$RESULT" | grep -q '"font"'; then
+    STATUS=1
+  fi
+done
+exit $STATUS